@@ -8,10 +8,21 @@ import time
 import subprocess
 import json
 import os
-from signal import signal, SIGTERM, SIGINT
+import pwd
+import functools
+import selectors
+import fcntl
+import ctypes
+from signal import signal, set_wakeup_fd, SIGTERM, SIGINT, SIGHUP, SIGRTMIN
 import sys
+import struct
 import logging
 
+try:
+    import smbus2 as smbus
+except ImportError:
+    import smbus
+
 # Layered shutdown thresholds
 VOLTAGE_CRITICAL = 3.2      # Immediate shutdown voltage
 VOLTAGE_WARNING = 3.3       # Warning voltage
@@ -20,7 +31,37 @@ PERCENTAGE_WARNING = 5      # Warning percentage (user)
 
 SHUTDOWN_DELAY = 15
 POLL_INTERVAL = 10          # Check every 10 seconds for faster response
+STATUS_TIMEOUT = 60         # Safety re-check when the status file is watched but quiet
+ALERT_PIN = 25              # MAX17043 ALRT output (open-drain, active low)
+USER_CACHE_TTL = 300        # Re-detect the desktop user at most every 5 minutes
 BATTERY_STATUS_FILE = '/tmp/battery_status.json'
+STATUS_STALE_AGE = 10       # Seconds before published data is too old to trust its voltage
+
+# Fuel gauge, read directly only when the published voltage has gone stale
+I2C_BUS = 3
+MAX17043_ADDRESS = 0x36
+VCELL_REGISTER = 0x02
+
+# GPIO character device (v1 line event ABI, linux/gpio.h)
+GPIO_CHIP = '/dev/gpiochip0'
+GPIO_GET_LINEEVENT_IOCTL = 0xC030B404          # _IOWR(0xB4, 0x04, struct gpioevent_request)
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = 0xC040B408  # _IOWR(0xB4, 0x08, struct gpiohandle_data)
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOHANDLE_REQUEST_BIAS_PULL_UP = 1 << 5
+GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+GPIOEVENT_REQUEST = struct.Struct('III32si')   # lineoffset, handleflags, eventflags, label, fd
+GPIOEVENT_DATA_SIZE = 16                       # u64 timestamp, u32 id + padding
+GPIOHANDLE_DATA_SIZE = 64
+
+# inotify (linux/inotify.h), used to wake when the status file is published
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct('iIII')          # wd, mask, cookie, len (name follows)
+
+# Login records (glibc struct utmp layout)
+UTMP_FILE = '/run/utmp'
+UTMP_RECORD = struct.Struct('hi32s4s32s256shhiii4i20s')
+USER_PROCESS = 7
 
 # Setup logging
 logging.basicConfig(
@@ -29,46 +70,334 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 
+def read_user_sessions():
+    """Return (username, line, host) for every logged-in user session in utmp
+    
+    Returns None if utmp can't be read.
+    """
+    try:
+        with open(UTMP_FILE, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    
+    sessions = []
+    usable = len(data) - len(data) % UTMP_RECORD.size
+    for record in UTMP_RECORD.iter_unpack(data[:usable]):
+        if record[0] != USER_PROCESS:
+            continue
+        line = record[2].split(b'\0', 1)[0].decode(errors='ignore')
+        user = record[4].split(b'\0', 1)[0].decode(errors='ignore')
+        host = record[5].split(b'\0', 1)[0].decode(errors='ignore')
+        if user and line:
+            sessions.append((user, line, host))
+    return sessions
+
+
+@functools.lru_cache(maxsize=8)
+def get_user_entry(username):
+    """Look up a user's passwd entry (uid, gid, home), None if unknown"""
+    try:
+        return pwd.getpwnam(username)
+    except KeyError:
+        return None
+
+
+class TerminalBroadcast:
+    """Broadcast messages to logged-in terminals without forking wall
+    
+    Terminal devices are opened once on entry and reused for every message,
+    so a countdown costs one write per terminal instead of a wall fork/exec.
+    Falls back to wall when no terminal could be opened.
+    """
+    
+    def __init__(self):
+        self.fds = []
+    
+    def __enter__(self):
+        for _, line, _ in read_user_sessions() or []:
+            if line.startswith(':'):  # X display, not a terminal device
+                continue
+            try:
+                self.fds.append(os.open(f'/dev/{line}', os.O_WRONLY | os.O_NOCTTY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        for fd in self.fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fds = []
+    
+    def send(self, message):
+        """Write a message to every open terminal"""
+        if not self.fds:
+            try:
+                subprocess.run(['wall', message], capture_output=True, timeout=2)
+            except Exception:
+                pass
+            return
+        
+        payload = f"\r\nBroadcast message from battery-alert:\r\n\r\n{message}\r\n".encode()
+        for fd in self.fds:
+            try:
+                os.write(fd, payload)
+            except OSError:
+                pass
+
+
 class LayeredAlertMonitor:
     def __init__(self):
         self.shutdown_initiated = False
         self.running = True
         self.last_warning_time = 0
         self.warning_shown = False
+        self._alert_fd = None
+        self._user_cache = (None, 0.0)
+        self._status_key = None
+        self._status_cache = None
+        self._selector = None
+        self._inotify_fd = None
+        self._status_watched = False
+        self._last_check = time.monotonic()
+        self.bus = None
+        self._env_by_uid = {}
         
     def signal_handler(self, signum, frame):
         """Clean shutdown"""
-        logging.info(f"Received signal {signum}, shutting down gracefully")
+        logging.info("Received signal %s, shutting down gracefully", signum)
+        # Waits select on the wakeup fd, so the main loop and any countdown exit promptly
         self.running = False
-        sys.exit(0)
+    
+    def setup_wakeup(self):
+        """Route signal arrival through a pipe so waits can be interrupted"""
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        set_wakeup_fd(write_fd)
+        
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(read_fd, selectors.EVENT_READ)
+    
+    def wait_until(self, deadline):
+        """Sleep until a time.monotonic() deadline
+        
+        Returns False if a signal stopped the monitor before the deadline.
+        """
+        while self.running:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return True
+            if self._selector is None:
+                time.sleep(timeout)
+                continue
+            for key, _ in self._selector.select(timeout):
+                self._drain(key.fd)
+        return False
+    
+    @staticmethod
+    def _drain(fd):
+        """Read everything pending on a non-blocking fd"""
+        chunks = []
+        try:
+            while True:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+        return b''.join(chunks)
+    
+    def reload_handler(self, signum, frame):
+        """Forget the cached desktop user (SIGHUP)"""
+        logging.info("Received SIGHUP, clearing cached user info")
+        self._user_cache = (None, 0.0)
+        
+    def setup_gpio(self):
+        """Request falling-edge events on the fuel gauge ALRT line from the gpiochip"""
+        chip_fd = None
+        try:
+            chip_fd = os.open(GPIO_CHIP, os.O_RDONLY | os.O_CLOEXEC)
+            request = bytearray(GPIOEVENT_REQUEST.pack(
+                ALERT_PIN,
+                GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_UP,
+                GPIOEVENT_REQUEST_FALLING_EDGE,
+                b'battery-alert',
+                0))
+            fcntl.ioctl(chip_fd, GPIO_GET_LINEEVENT_IOCTL, request)
+            self._alert_fd = GPIOEVENT_REQUEST.unpack(request)[4]
+            os.set_blocking(self._alert_fd, False)
+            self._selector.register(self._alert_fd, selectors.EVENT_READ)
+        except OSError as e:
+            logging.error("GPIO setup failed, falling back to timed polling: %s", e)
+        finally:
+            # The line event fd stays valid after the chip fd is closed
+            if chip_fd is not None:
+                os.close(chip_fd)
+    
+    def alert_asserted(self):
+        """Read the current ALRT line level (active low)"""
+        values = bytearray(GPIOHANDLE_DATA_SIZE)
+        fcntl.ioctl(self._alert_fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, values)
+        return values[0] == 0
+    
+    def setup_inotify(self):
+        """Watch the status file directory so a fresh publish wakes the monitor"""
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            # Watch the directory - the oneshot renames a temp file over the status file
+            status_dir = os.path.dirname(BATTERY_STATUS_FILE).encode()
+            if libc.inotify_add_watch(fd, status_dir, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, "inotify_add_watch failed")
+            # Registered with the selector by wait_for_alert once publishes may be acted on
+            self._inotify_fd = fd
+        except (OSError, AttributeError) as e:
+            logging.error("inotify setup failed, falling back to timed polling: %s", e)
+    
+    def status_published(self, data):
+        """Check a batch of inotify events for the battery status file"""
+        name = os.path.basename(BATTERY_STATUS_FILE).encode()
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            if data[offset:offset + length].rstrip(b'\0') == name:
+                return True
+            offset += length
+        return False
+    
+    def wait_for_alert(self):
+        """Block until ALRT falls, new status is published, a signal arrives or the timeout elapses
+        
+        Returns True if the fuel gauge asserted its alert line.
+        """
+        # The kernel wakes us exactly when the line transitions, the file is
+        # published or a signal lands; the timeout is only a safety net
+        timeout = STATUS_TIMEOUT if self._inotify_fd is not None else POLL_INTERVAL
+        deadline = self._last_check + timeout
+        # The monitor publishes every couple of seconds; act on that at most once per
+        # POLL_INTERVAL by not watching the file until then. Events queued meanwhile
+        # are read in one go when the watch is resumed. ALRT edges are always immediate.
+        quiet_until = self._last_check + POLL_INTERVAL
+        edge = False
+        published = False
+        while self.running and not (edge or published):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wake = deadline
+            if self._inotify_fd is not None and not self._status_watched:
+                if now >= quiet_until:
+                    self._selector.register(self._inotify_fd, selectors.EVENT_READ)
+                    self._status_watched = True
+                else:
+                    wake = min(deadline, quiet_until)
+            for key, _ in self._selector.select(wake - now):
+                data = self._drain(key.fd)
+                if key.fd == self._alert_fd:
+                    edge = True
+                elif key.fd == self._inotify_fd:
+                    # Other files in /tmp change too - keep sleeping for those
+                    published = published or self.status_published(data)
+        
+        if self._status_watched:
+            self._selector.unregister(self._inotify_fd)
+            self._status_watched = False
+        self._last_check = time.monotonic()
+        
+        if not edge:
+            return False
+        
+        # Debounce - only trust the edge if the line is still asserted
+        try:
+            return self.alert_asserted()
+        except OSError as e:
+            logging.error("Failed to read ALRT line: %s", e)
+            return False
         
     def get_battery_data(self):
-        """Read battery data from JSON file"""
+        """Read battery data from JSON file, re-parsing only when it changes"""
         try:
-            with open(BATTERY_STATUS_FILE, 'r') as f:
-                data = json.load(f)
+            st = os.stat(BATTERY_STATUS_FILE)
+            # Every publish renames a new file into place, so the inode changes with it
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if key == self._status_key:
+                return self._status_cache
+            
+            fd = os.open(BATTERY_STATUS_FILE, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                # Key the cache on the file actually read, in case it was replaced since the stat
+                st = os.fstat(fd)
+                key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                data = json.loads(os.read(fd, max(st.st_size, 4096)))
+            finally:
+                os.close(fd)
             
             battery = data.get('battery', {})
-            return {
+            self._status_cache = {
                 'voltage': battery.get('voltage', 0),
                 'percent_user': battery.get('percent_user', 0),
                 'percent_raw': battery.get('percent_raw', 0),
                 'timestamp': battery.get('timestamp', 0),
                 'error': battery.get('error', None)
             }
-        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self._status_key = key
+            return self._status_cache
+        except (OSError, json.JSONDecodeError, KeyError):
             return None
     
-    def check_shutdown_conditions(self):
-        """Layered battery condition checking"""
+    def setup_i2c(self):
+        """Open the fuel gauge bus once for the life of the monitor"""
+        try:
+            self.bus = smbus.SMBus(I2C_BUS)
+        except Exception as e:
+            logging.warning("I2C setup failed, using status file voltage only: %s", e)
+    
+    def read_live_voltage(self):
+        """Read cell voltage straight from the MAX17043, None on failure"""
+        if self.bus is None:
+            return None
+        try:
+            data = self.bus.read_i2c_block_data(MAX17043_ADDRESS, VCELL_REGISTER, 2)
+        except OSError as e:
+            logging.warning("Live voltage read failed: %s", e)
+            return None
+        return (int.from_bytes(bytes(data), 'big') >> 4) * 1.25 / 1000.0
+    
+    def read_battery(self):
+        """Status file data, with a live gauge voltage only if the monitor stopped publishing
+        
+        Fresh published data is used as-is: the monitor read VCELL moments ago, and a
+        second raw sample would only add bus traffic and one more chance of a glitched read.
+        """
         battery = self.get_battery_data()
+        if not battery or battery.get('error'):
+            return battery
+        if time.time() - battery['timestamp'] <= STATUS_STALE_AGE:
+            return battery
         
+        voltage = self.read_live_voltage()
+        if voltage is None:
+            return battery
+        return dict(battery, voltage=voltage)
+    
+    def check_shutdown_conditions(self, battery):
+        """Layered battery condition checking"""
         if not battery:
             logging.warning("Cannot read battery data - continuing monitoring")
             return "OK"
         
         if battery.get('error'):
-            logging.warning(f"Battery error: {battery['error']}")
+            logging.warning("Battery error: %s", battery['error'])
             return "OK"  # Don't shutdown on read errors
         
         voltage = battery['voltage']
@@ -76,92 +405,125 @@ class LayeredAlertMonitor:
         
         # Layer 1: Critical voltage protection (most reliable)
         if voltage <= VOLTAGE_CRITICAL and voltage > 0:
-            logging.critical(f"CRITICAL VOLTAGE: {voltage:.3f}V <= {VOLTAGE_CRITICAL}V")
+            logging.critical("CRITICAL VOLTAGE: %.3fV <= %sV", voltage, VOLTAGE_CRITICAL)
             return "CRITICAL_VOLTAGE"
         
         # Layer 2: Critical percentage protection
         if percentage <= PERCENTAGE_CRITICAL:
-            logging.critical(f"CRITICAL PERCENTAGE: {percentage:.1f}% <= {PERCENTAGE_CRITICAL}%")
+            logging.critical("CRITICAL PERCENTAGE: %.1f%% <= %s%%", percentage, PERCENTAGE_CRITICAL)
             return "CRITICAL_PERCENTAGE"
         
         # Layer 3: Combined warning thresholds
         if voltage <= VOLTAGE_WARNING and voltage > 0:
-            logging.warning(f"LOW VOLTAGE WARNING: {voltage:.3f}V <= {VOLTAGE_WARNING}V")
+            logging.warning("LOW VOLTAGE WARNING: %.3fV <= %sV", voltage, VOLTAGE_WARNING)
             return "WARNING_VOLTAGE"
         
         if percentage <= PERCENTAGE_WARNING:
-            logging.warning(f"LOW PERCENTAGE WARNING: {percentage:.1f}% <= {PERCENTAGE_WARNING}%")
+            logging.warning("LOW PERCENTAGE WARNING: %.1f%% <= %s%%", percentage, PERCENTAGE_WARNING)
             return "WARNING_PERCENTAGE"
         
         return "OK"
     
     def get_active_user_info(self):
+        """Get the desktop user, re-detecting only when the cache expires"""
+        username, cached_at = self._user_cache
+        if username and time.monotonic() - cached_at < USER_CACHE_TTL:
+            return username
+        
+        username = self._detect_active_user()
+        self._user_cache = (username, time.monotonic())
+        return username
+    
+    def _detect_active_user(self):
         """Get the currently logged-in user and their display info"""
         try:
-            # Find the active user session
-            result = subprocess.run(['who'], capture_output=True, text=True)
-            logging.info(f"WHO output: {result.stdout.strip()}")
-            
-            if result.returncode == 0 and result.stdout:
-                # Get first logged-in user (usually the desktop user)
-                lines = result.stdout.strip().split('\n')
-                for line in lines:
-                    logging.info(f"Checking line: {line}")
-                    if ':0' in line or 'tty7' in line:  # Desktop session indicators
-                        username = line.split()[0]
-                        logging.info(f"Found desktop user: {username}")
+            # Find the active user session straight from utmp, no who(1) fork
+            sessions = read_user_sessions()
+            if sessions is not None:
+                for username, line, host in sessions:
+                    logging.debug("Checking session: %s %s (%s)", username, line, host)
+                    # Desktop session indicators
+                    if line in (':0', 'tty7') or host == ':0':
+                        logging.info("Found desktop user: %s", username)
                         return username
+            else:
+                # utmp unreadable - fall back to who
+                result = subprocess.run(['who'], capture_output=True, text=True)
+                logging.debug("WHO output: %s", result.stdout.strip())
+                
+                if result.returncode == 0 and result.stdout:
+                    # Get first logged-in user (usually the desktop user)
+                    lines = result.stdout.strip().split('\n')
+                    for line in lines:
+                        logging.debug("Checking line: %s", line)
+                        if ':0' in line or 'tty7' in line:  # Desktop session indicators
+                            username = line.split()[0]
+                            logging.info("Found desktop user: %s", username)
+                            return username
             
             # Fallback: check for common user
-            result = subprocess.run(['ls', '/home'], capture_output=True, text=True)
-            if result.returncode == 0:
-                users = result.stdout.strip().split('\n')
-                for user in users:
-                    if user and user != 'lost+found':
-                        logging.info(f"Fallback user: {user}")
-                        return user
+            try:
+                users = sorted(entry.name for entry in os.scandir('/home')
+                               if entry.is_dir() and entry.name != 'lost+found')
+            except OSError:
+                users = []
+            if users:
+                logging.info("Fallback user: %s", users[0])
+                return users[0]
             
             logging.info("Using final fallback: pi")
             return 'pi'  # Final fallback
         except Exception as e:
-            logging.error(f"Error getting user info: {e}")
+            logging.error("Error getting user info: %s", e)
             return 'pi'
     
     def run_as_user(self, username, command):
         """Run a command as a specific user with their environment"""
         try:
             # Get user's UID
-            uid_result = subprocess.run(['id', '-u', username], capture_output=True, text=True)
-            if uid_result.returncode != 0:
-                logging.error(f"Could not get UID for user {username}")
+            user = get_user_entry(username)
+            if user is None:
+                logging.error("Could not get UID for user %s", username)
                 return
-            uid = uid_result.stdout.strip()
-            logging.info(f"Running command as user {username} (UID: {uid})")
-            
-            # Use sudo -u instead of su to avoid command parsing issues
-            sudo_command = ['sudo', '-u', username] + command
+            uid = user.pw_uid
+            logging.debug("Running command as user %s (UID: %s)", username, uid)
             
-            # Set up environment - use simple approach that works
-            env = os.environ.copy()
-            env.update({
-                'DISPLAY': ':0',
-                'DBUS_SESSION_BUS_ADDRESS': f'unix:path=/run/user/{uid}/bus'
-            })
+            # Minimal desktop session environment, built once per user
+            env = self._env_by_uid.get(uid)
+            if env is None:
+                env = {
+                    'PATH': '/usr/local/bin:/usr/bin:/bin',
+                    'HOME': user.pw_dir,
+                    'USER': username,
+                    'DISPLAY': ':0',
+                    'XDG_RUNTIME_DIR': f'/run/user/{uid}',
+                    'DBUS_SESSION_BUS_ADDRESS': f'unix:path=/run/user/{uid}/bus'
+                }
+                self._env_by_uid[uid] = env
             
-            logging.info(f"Executing: {' '.join(sudo_command)}")
-            
-            # Use Popen approach like the working old script (fire and forget)
-            subprocess.Popen(sudo_command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            logging.info(f"Command launched successfully")
+            if os.geteuid() == 0:
+                # Already root - drop privileges in the child directly, skipping sudo's exec and PAM
+                logging.debug("Executing as %s: %s", username, command)
+                subprocess.Popen(command, env=env, user=uid, group=user.pw_gid,
+                                 extra_groups=os.getgrouplist(username, user.pw_gid),
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                # Use sudo -u instead of su to avoid command parsing issues
+                sudo_command = ['sudo', '-u', username] + command
+                logging.debug("Executing: %s", sudo_command)
+                
+                # Use Popen approach like the working old script (fire and forget)
+                subprocess.Popen(sudo_command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            logging.debug("Command launched successfully")
             
         except Exception as e:
-            logging.error(f"Failed to run command as user {username}: {e}")
+            logging.error("Failed to run command as user %s: %s", username, e)
             # Fallback - try direct execution
             try:
                 logging.info("Trying direct execution fallback")
                 subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             except Exception as e2:
-                logging.error(f"Direct execution fallback also failed: {e2}")
+                logging.error("Direct execution fallback also failed: %s", e2)
     
     def show_desktop_warning(self, username, title, message, timeout=5, use_dialog=False):
         """Show desktop notification as the specified user"""        
@@ -170,19 +532,40 @@ class LayeredAlertMonitor:
                 # Show prominent ERROR dialog (more attention-grabbing than warning)
                 zenity_cmd = ['zenity', '--error', '--title', title, '--text', message, 
                              f'--timeout={timeout}']
-                logging.info(f"Showing ERROR dialog: {title}")
+                logging.info("Showing ERROR dialog: %s", title)
             else:
                 # Use info dialog for less critical messages
                 zenity_cmd = ['zenity', '--info', '--title', title, '--text', message, 
                              f'--timeout={timeout}']
-                logging.info(f"Showing INFO dialog: {title}")
+                logging.info("Showing INFO dialog: %s", title)
             
             self.run_as_user(username, zenity_cmd)
             
         except Exception as e:
-            logging.error(f"Failed to show desktop warning: {e}")
+            logging.error("Failed to show desktop warning: %s", e)
+    
+    def show_notification(self, username, title, message, urgency='normal'):
+        """Post a desktop notification through the user's running notification daemon
+        
+        Much lighter than a zenity dialog since no GTK stack is started.
+        """
+        notify_cmd = ['notify-send', '--app-name=battery-alert', '--icon=battery-caution-symbolic',
+                      f'--urgency={urgency}', title, message]
+        logging.info("Showing notification: %s", title)
+        self.run_as_user(username, notify_cmd)
     
-    def show_low_battery_warning(self, condition, voltage, percentage):
+    def _announce(self, broadcast, message, level=logging.CRITICAL, dialog=None):
+        """Send a message to terminals and the log, plus an optional desktop dialog
+        
+        dialog holds the show_desktop_warning arguments
+        (username, title, text, timeout, use_dialog).
+        """
+        broadcast.send(message)
+        if dialog is not None:
+            self.show_desktop_warning(*dialog)
+        logging.log(level, message)
+    
+    def show_low_battery_warning(self, condition, battery):
         """Show low battery warning (non-critical)"""
         current_time = time.time()
         
@@ -191,6 +574,8 @@ class LayeredAlertMonitor:
             return
         
         self.last_warning_time = current_time
+        voltage = battery['voltage']
+        percentage = battery['percent_user']
         username = self.get_active_user_info()
         
         if condition == "WARNING_VOLTAGE":
@@ -202,20 +587,14 @@ class LayeredAlertMonitor:
         
         wall_message = f"LOW BATTERY WARNING: {voltage:.2f}V, {percentage:.1f}% - Connect charger!"
         
-        try:
-            subprocess.run(['wall', wall_message], capture_output=True, timeout=2)
-        except:
-            pass
-        
-        try:
-            self.show_desktop_warning(username, title, message, 10, use_dialog=False)
-        except:
-            pass
-        
-        logging.warning(wall_message)
+        with TerminalBroadcast() as broadcast:
+            self._announce(broadcast, wall_message, logging.WARNING)
+        self.show_notification(username, title, message)
     
-    def show_critical_shutdown_countdown(self, condition, voltage, percentage):
+    def show_critical_shutdown_countdown(self, condition, battery):
         """Critical shutdown with countdown"""
+        voltage = battery['voltage']
+        percentage = battery['percent_user']
         try:
             username = self.get_active_user_info()
             
@@ -231,63 +610,68 @@ class LayeredAlertMonitor:
             initial_dialog_text = f"{dialog_reason}\n\nSystem will shutdown in {SHUTDOWN_DELAY} seconds\nto protect the battery.\n\nSave your work NOW!"
             initial_msg = f"CRITICAL: Battery {reason}! System shutdown in {SHUTDOWN_DELAY} seconds - SAVE YOUR WORK!"
             
-            # Show dialog and CLI message
-            try:
-                subprocess.run(['wall', initial_msg], capture_output=True, timeout=2)
-            except:
-                pass
-            
-            try:
-                self.show_desktop_warning(username, "CRITICAL BATTERY ALERT", initial_dialog_text, SHUTDOWN_DELAY, use_dialog=True)
-            except:
-                pass
+            with TerminalBroadcast() as broadcast:
+                # Show dialog and CLI message
+                self._announce(broadcast, initial_msg,
+                               dialog=(username, "CRITICAL BATTERY ALERT", initial_dialog_text, SHUTDOWN_DELAY, True))
                 
-            logging.critical(f"CRITICAL: Battery {reason}! System shutdown in {SHUTDOWN_DELAY} seconds!")
-            
-            # Countdown with regular warnings
-            for remaining in range(SHUTDOWN_DELAY, 0, -1):
-                if remaining <= 5 or remaining % 5 == 0:
-                    if remaining <= 5:
-                        message = f"CRITICAL SHUTDOWN IN {remaining} SECONDS!"
-                    else:
-                        message = f"CRITICAL: Battery {reason}! Shutdown in {remaining} seconds - SAVE YOUR WORK!"
-                    
-                    # CLI broadcast
-                    try:
-                        subprocess.run(['wall', message], capture_output=True, timeout=1)
-                    except:
-                        pass
-                    logging.critical(message)
+                # Countdown with regular warnings (terminals only, no dialogs).
+                # Every 5 seconds, then each of the last 5 seconds.
+                schedule = [
+                    (remaining,
+                     f"CRITICAL SHUTDOWN IN {remaining} SECONDS!" if remaining <= 5 else
+                     f"CRITICAL: Battery {reason}! Shutdown in {remaining} seconds - SAVE YOUR WORK!")
+                    for remaining in range(SHUTDOWN_DELAY, 0, -1)
+                    if remaining <= 5 or remaining % 5 == 0
+                ]
                 
-                time.sleep(1)
-            
-            # Final warning
-            final_dialog_text = f"System shutting down now to protect battery.\n\nReason: {reason.capitalize()}\n\nPlease connect charger before restarting."
-            final_msg = f"EMERGENCY SHUTDOWN: Battery {reason}"
-            
-            try:
-                subprocess.run(['wall', final_msg], capture_output=True, timeout=1)
-                self.show_desktop_warning(username, "EMERGENCY SHUTDOWN", final_dialog_text, 3, use_dialog=True)
-            except:
-                pass
-            logging.critical(final_msg)
+                # Events are pinned to a monotonic start so slow output can't stretch it
+                start = time.monotonic()
+                for remaining, message in schedule:
+                    if not self.wait_until(start + SHUTDOWN_DELAY - remaining):
+                        logging.warning("Shutdown countdown aborted by signal")
+                        return
+                    self._announce(broadcast, message)
+                
+                if not self.wait_until(start + SHUTDOWN_DELAY):
+                    logging.warning("Shutdown countdown aborted by signal")
+                    return
+                
+                # Final warning
+                final_dialog_text = f"System shutting down now to protect battery.\n\nReason: {reason.capitalize()}\n\nPlease connect charger before restarting."
+                final_msg = f"EMERGENCY SHUTDOWN: Battery {reason}"
+                
+                self._announce(broadcast, final_msg,
+                               dialog=(username, "EMERGENCY SHUTDOWN", final_dialog_text, 3, True))
             
             # Emergency shutdown
-            time.sleep(2)
-            subprocess.run(['sudo', 'shutdown', '-h', 'now'])
+            if not self.wait_until(time.monotonic() + 2):
+                logging.warning("Shutdown aborted by signal")
+                return
+            self.power_off()
             
         except Exception as e:
-            logging.error(f"Error during shutdown countdown: {e}")
+            logging.error("Error during shutdown countdown: %s", e)
             # Emergency shutdown
+            self.power_off()
+    
+    def power_off(self):
+        """Power the system off without forking on the dying-battery path"""
+        # Assumes systemd is PID 1: it treats SIGRTMIN+4 as "systemctl poweroff".
+        # Only root may signal init, so fall back to shutdown otherwise.
+        try:
+            os.kill(1, SIGRTMIN + 4)
+        except (PermissionError, ProcessLookupError) as e:
+            logging.warning("Cannot signal init (%s), falling back to shutdown", e)
             subprocess.run(['sudo', 'shutdown', '-h', 'now'])
     
     def log_battery_status(self):
         """Log current battery status for monitoring"""
-        battery = self.get_battery_data()
+        battery = self.read_battery()
         if battery:
             voltage = battery['voltage']
             percentage = battery['percent_user']
-            logging.info(f"Battery status: {voltage:.3f}V, {percentage:.1f}% user")
+            logging.info("Battery status: %.3fV, %.1f%% user", voltage, percentage)
         else:
             logging.warning("Could not read battery status")
     
@@ -295,31 +679,35 @@ class LayeredAlertMonitor:
         """Main monitoring loop with layered protection"""
         try:
             logging.info("Layered battery alert monitor started")
-            logging.info(f"Thresholds - Critical: {VOLTAGE_CRITICAL}V/{PERCENTAGE_CRITICAL}%, Warning: {VOLTAGE_WARNING}V/{PERCENTAGE_WARNING}%")
+            logging.info("Thresholds - Critical: %sV/%s%%, Warning: %sV/%s%%",
+                         VOLTAGE_CRITICAL, PERCENTAGE_CRITICAL, VOLTAGE_WARNING, PERCENTAGE_WARNING)
             
             # Log initial status
+            self.setup_i2c()
             self.log_battery_status()
+            self.setup_wakeup()
+            self.setup_gpio()
+            self.setup_inotify()
             
             while self.running:
-                time.sleep(POLL_INTERVAL)
+                if self.wait_for_alert():
+                    logging.warning("Fuel gauge ALRT asserted - checking battery now")
+                if not self.running:
+                    break
                 
-                condition = self.check_shutdown_conditions()
+                # One read per iteration, shared by the check and the alerts
+                battery = self.read_battery()
+                condition = self.check_shutdown_conditions(battery)
                 
                 if condition.startswith("CRITICAL") and not self.shutdown_initiated:
                     self.shutdown_initiated = True
-                    battery = self.get_battery_data()
-                    voltage = battery['voltage'] if battery else 0
-                    percentage = battery['percent_user'] if battery else 0
                     
-                    logging.critical(f"CRITICAL BATTERY CONDITION: {condition}")
-                    self.show_critical_shutdown_countdown(condition, voltage, percentage)
+                    logging.critical("CRITICAL BATTERY CONDITION: %s", condition)
+                    self.show_critical_shutdown_countdown(condition, battery)
                     break
                 
                 elif condition.startswith("WARNING"):
-                    battery = self.get_battery_data()
-                    voltage = battery['voltage'] if battery else 0
-                    percentage = battery['percent_user'] if battery else 0
-                    self.show_low_battery_warning(condition, voltage, percentage)
+                    self.show_low_battery_warning(condition, battery)
                 
                 elif condition == "OK":
                     # Reset warning state when battery is good
@@ -328,8 +716,13 @@ class LayeredAlertMonitor:
                         logging.info("Battery level returned to normal")
                 
         except Exception as e:
-            logging.error(f"Error in layered battery monitor: {e}")
+            logging.error("Error in layered battery monitor: %s", e)
         finally:
+            for fd in (self._alert_fd, self._inotify_fd):
+                if fd is not None:
+                    os.close(fd)
+            if self.bus is not None:
+                self.bus.close()
             logging.info("Battery monitor shutdown")
 
 if __name__ == "__main__":
@@ -350,10 +743,16 @@ if __name__ == "__main__":
         print("Testing ERROR dialog...")
         monitor.show_desktop_warning(username, "Test Error", "This is a test error dialog", 5, use_dialog=True)
         
+        time.sleep(2)
+        
+        print("Testing notification...")
+        monitor.show_notification(username, "Test Notification", "This is a test notification")
+        
         sys.exit(0)
     
     # Normal operation
     monitor = LayeredAlertMonitor()
     signal(SIGTERM, monitor.signal_handler)
     signal(SIGINT, monitor.signal_handler)
+    signal(SIGHUP, monitor.reload_handler)
     monitor.run()
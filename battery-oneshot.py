@@ -2,20 +2,43 @@
 """
 MAX17043 Battery Monitor Script
 Handles charging transitions, bad reading detection, and quick-start management
+
+Runs one cycle per invocation, or with --daemon [PERIOD] keeps the bus and state
+resident and runs a cycle every PERIOD seconds (battery-monitor.service).
+
+Bus 3 is bit-banged by i2c-gpio; every run is bound by SMBus transaction time,
+so config.txt sets i2c_gpio_delay_us=1 (~250 kHz instead of the ~100 kHz default).
 """
 
 import json
+import os
+import sys
+import signal
+import struct
+import bisect
+import tempfile
+import functools
 import time
 import logging
-from pathlib import Path
-from typing import Optional, Dict, Any
-import RPi.GPIO as GPIO
+import logging.handlers
+from typing import Optional, Dict, Any, List
+import lgpio
 
 try:
     import smbus2 as smbus
 except ImportError:
     import smbus
 
+try:
+    import orjson
+    dump_json = orjson.dumps
+except ImportError:
+    # One encoder for the life of the process instead of one per json.dumps call
+    _encode_json = json.JSONEncoder(separators=(',', ':')).encode
+    
+    def dump_json(obj: Any) -> bytes:
+        return _encode_json(obj).encode()
+
 # Configuration constants
 MAX17043_ADDRESS = 0x36
 VCELL_REGISTER = 0x02
@@ -23,12 +46,19 @@ SOC_REGISTER = 0x04
 MODE_REGISTER = 0x06
 QUICK_START_COMMAND = 0x4000
 
+GPIO_CHIP = 0
 CHARGE_DETECT_PIN = 4
 STATUS_FILE = '/tmp/battery_status.json'
-STATE_FILE = '/tmp/battery_monitor_state.json'
+STATE_FILE = '/dev/shm/battery_monitor_state.bin'
+STATE_RECORD = struct.Struct('<dd?3d')  # last_quick_start, charging_window_start, last_charger_state, recent voltages
+VOLTAGE_HISTORY = 3  # Samples in the median filter for bad-reading checks
 
+DAEMON_PERIOD = 2.0  # Default seconds between cycles in --daemon mode
 CHARGING_WINDOW_DURATION = 300  # 5 minutes in seconds
 QUICK_START_COOLDOWN = 300  # 5 minutes in seconds
+QUICK_START_SETTLE = 2.0  # Max wait for a recomputed SOC after quick-start
+QUICK_START_MIN_SETTLE = 1.0  # Earliest a recomputed SOC is accepted
+QUICK_START_POLL = 0.25  # Re-read interval while waiting (about the gauge's update period)
 BAD_READING_THRESHOLD = 0.20  # 20% deviation threshold
 
 # Standard Li-ion voltage curve (voltage -> expected SOC%)
@@ -39,22 +69,80 @@ LIION_VOLTAGE_CURVE = [
     (3.45, 25), (3.40, 20), (3.35, 15), (3.30, 10), (3.25, 5), (3.00, 0)
 ]
 
+# Ascending copies of the curve for bisect lookups
+CURVE_VOLTAGES = [v for v, _ in reversed(LIION_VOLTAGE_CURVE)]
+CURVE_SOCS = [soc for _, soc in reversed(LIION_VOLTAGE_CURVE)]
+VCELL_STEPS_PER_VOLT = 800  # 1.25 mV VCELL resolution
+
+
+@functools.lru_cache(maxsize=4096)
+def expected_soc_for_step(step: int) -> float:
+    """Interpolate the li-ion curve at a VCELL step (1.25 mV units)"""
+    voltage = step / VCELL_STEPS_PER_VOLT
+    if voltage >= CURVE_VOLTAGES[-1]:
+        return CURVE_SOCS[-1]
+    if voltage <= CURVE_VOLTAGES[0]:
+        return CURVE_SOCS[0]
+    
+    # Binary search for the bracketing points, then linear interpolation
+    i = bisect.bisect_right(CURVE_VOLTAGES, voltage)
+    v1, v2 = CURVE_VOLTAGES[i - 1], CURVE_VOLTAGES[i]
+    soc1, soc2 = CURVE_SOCS[i - 1], CURVE_SOCS[i]
+    return soc1 + (voltage - v1) / (v2 - v1) * (soc2 - soc1)
+
+
+def replace_file(path: str, data: bytes, mode: int):
+    """Atomically replace path with data
+    
+    The temp file gets an unpredictable name created with O_EXCL, so nothing planted
+    in a shared directory like /tmp can intercept or take over the write.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        try:
+            os.fchmod(fd, mode)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def _no_charger() -> bool:
+    """Charge reader used when the detect pin is unavailable"""
+    return False
+
 
 class BatteryMonitor:
     def __init__(self):
         self.logger = self._setup_logging()
         self.bus = None
-        self.gpio_ready = False
+        self.gpio_handle = None
+        self._read_charge = _no_charger  # Bound to the real pin once it reads cleanly
+        self._charging = None
+        self._now = 0.0
         self.state = self._load_state()
+        self._saved_voltages = list(self.state['recent_voltages'])  # Ring as last written
         
     def _setup_logging(self) -> logging.Logger:
         """Setup logging configuration"""
+        log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        # The MemoryHandler only buffers records; the file handler formats them
+        file_handler = logging.FileHandler('/tmp/battery_monitor.log')
+        file_handler.setFormatter(logging.Formatter(log_format))
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            format=log_format,
             handlers=[
                 logging.StreamHandler(),
-                logging.FileHandler('/tmp/battery_monitor.log')
+                # Batch file writes; errors and process exit flush immediately
+                logging.handlers.MemoryHandler(
+                    capacity=64,
+                    flushLevel=logging.ERROR,
+                    target=file_handler
+                )
             ]
         )
         return logging.getLogger('BatteryMonitor')
@@ -62,58 +150,83 @@ class BatteryMonitor:
     def _load_state(self) -> Dict[str, Any]:
         """Load persistent state from file"""
         try:
-            if Path(STATE_FILE).exists():
-                with open(STATE_FILE, 'r') as f:
-                    return json.load(f)
-        except (json.JSONDecodeError, OSError) as e:
-            self.logger.warning(f"Could not load state file: {e}")
+            fd = os.open(STATE_FILE, os.O_RDONLY)
+            try:
+                record = os.read(fd, STATE_RECORD.size)
+            finally:
+                os.close(fd)
+            if len(record) == STATE_RECORD.size:
+                last_quick_start, window_start, last_charger, *voltages = STATE_RECORD.unpack(record)
+                return {
+                    'last_quick_start': last_quick_start,
+                    'charging_window_start': window_start,
+                    'last_charger_state': last_charger,
+                    'recent_voltages': voltages
+                }
+            self.logger.warning("Ignoring truncated state file")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning("Could not load state file: %s", e)
         
         return {
             'last_quick_start': 0,
             'charging_window_start': 0,
-            'last_charger_state': False
+            'last_charger_state': False,
+            'recent_voltages': [0.0] * VOLTAGE_HISTORY
         }
     
     def _save_state(self):
         """Save persistent state to file"""
         try:
-            with open(STATE_FILE, 'w') as f:
-                json.dump(self.state, f, indent=2)
+            record = STATE_RECORD.pack(
+                self.state['last_quick_start'],
+                self.state['charging_window_start'],
+                self.state['last_charger_state'],
+                *self.state['recent_voltages']
+            )
+            # Replace atomically so a crash mid-write can't leave a truncated record behind
+            replace_file(STATE_FILE, record, 0o644)
+            self._saved_voltages = list(self.state['recent_voltages'])
         except OSError as e:
-            self.logger.error(f"Could not save state file: {e}")
+            self.logger.error("Could not save state file: %s", e)
     
     def _init_i2c(self) -> bool:
         """Initialize I2C bus"""
         try:
+            # No probe read - a missing chip shows up in the VCELL/SOC read anyway
             self.bus = smbus.SMBus(3)
-            # Test communication by reading version register
-            self.bus.read_word_data(MAX17043_ADDRESS, 0x08)
             return True
-        except Exception as e:
-            self.logger.error(f"I2C initialization failed: {e}")
+        except OSError as e:
+            self.logger.error("I2C initialization failed: %s", e)
             return False
     
     def _init_gpio(self) -> bool:
         """Initialize GPIO for charge detection"""
+        handle = None
         try:
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setup(CHARGE_DETECT_PIN, GPIO.IN)
-            self.gpio_ready = True
+            # Claim the line through the gpiochip character device
+            handle = lgpio.gpiochip_open(GPIO_CHIP)
+            lgpio.gpio_claim_input(handle, CHARGE_DETECT_PIN)
+            lgpio.gpio_read(handle, CHARGE_DETECT_PIN)  # Probe once so a dead line is caught at startup
+            self.gpio_handle = handle
+            self._read_charge = lambda: lgpio.gpio_read(handle, CHARGE_DETECT_PIN) == 1
             return True
-        except Exception as e:
-            self.logger.error(f"GPIO initialization failed: {e}")
+        except lgpio.error as e:
+            self.logger.error("GPIO initialization failed: %s", e)
+            if handle is not None:
+                lgpio.gpiochip_close(handle)
             return False
     
-    def _read_register16(self, register: int) -> Optional[int]:
-        """Read 16-bit register from MAX17043"""
+    def _read_block(self, register: int, length: int) -> Optional[List[int]]:
+        """Read consecutive register bytes from MAX17043 in one transaction"""
         try:
             if self.bus is None:
                 return None
-            data = self.bus.read_word_data(MAX17043_ADDRESS, register)
-            # Swap bytes (SMBus returns little-endian, MAX17043 uses big-endian)
-            return ((data & 0xFF) << 8) | ((data >> 8) & 0xFF)
-        except Exception as e:
-            self.logger.error(f"Failed to read register 0x{register:02X}: {e}")
+            # Block reads return bytes in chip (big-endian) order, no swap needed
+            return self.bus.read_i2c_block_data(MAX17043_ADDRESS, register, length)
+        except OSError as e:
+            self.logger.error("Failed to read register 0x%02X: %s", register, e)
             return None
     
     def _write_register16(self, register: int, value: int) -> bool:
@@ -121,27 +234,28 @@ class BatteryMonitor:
         try:
             if self.bus is None:
                 return False
-            # Swap bytes for big-endian format
-            swapped = ((value & 0xFF) << 8) | ((value >> 8) & 0xFF)
-            self.bus.write_word_data(MAX17043_ADDRESS, register, swapped)
+            # Block writes go out in chip (big-endian) order, no swap needed
+            self.bus.write_i2c_block_data(MAX17043_ADDRESS, register, list(struct.pack('>H', value)))
             return True
-        except Exception as e:
-            self.logger.error(f"Failed to write register 0x{register:02X}: {e}")
+        except OSError as e:
+            self.logger.error("Failed to write register 0x%02X: %s", register, e)
             return False
     
     def _is_charging(self) -> bool:
-        """Check if charger is currently connected"""
-        if not self.gpio_ready:
-            return False
-        try:
-            return GPIO.input(CHARGE_DETECT_PIN) == GPIO.HIGH
-        except Exception as e:
-            self.logger.error(f"Failed to read charge detection pin: {e}")
-            return False
+        """Check if charger is currently connected (pin is read once per cycle)"""
+        if self._charging is None:
+            try:
+                self._charging = self._read_charge()
+            except lgpio.error as e:
+                # Stop reading a line that went bad instead of failing every cycle
+                self.logger.error("Failed to read charge detection pin: %s", e)
+                self._read_charge = _no_charger
+                self._charging = False
+        return self._charging
     
     def _is_in_charging_window(self) -> bool:
         """Check if we're in a charging window period"""
-        current_time = time.time()
+        current_time = self._now
         window_start = self.state.get('charging_window_start', 0)
         
         # If currently charging, we're always in window
@@ -159,7 +273,7 @@ class BatteryMonitor:
         """Update charging window state"""
         current_charging = self._is_charging()
         last_charging = self.state.get('last_charger_state', False)
-        current_time = time.time()
+        current_time = self._now
         
         # Charger was disconnected
         if last_charging and not current_charging:
@@ -179,22 +293,19 @@ class BatteryMonitor:
     
     def _get_expected_soc_from_voltage(self, voltage: float) -> float:
         """Get expected SOC percentage from voltage using li-ion curve"""
-        if voltage >= LIION_VOLTAGE_CURVE[0][0]:
-            return LIION_VOLTAGE_CURVE[0][1]
-        if voltage <= LIION_VOLTAGE_CURVE[-1][0]:
-            return LIION_VOLTAGE_CURVE[-1][1]
-        
-        # Linear interpolation between curve points
-        for i in range(len(LIION_VOLTAGE_CURVE) - 1):
-            v1, soc1 = LIION_VOLTAGE_CURVE[i]
-            v2, soc2 = LIION_VOLTAGE_CURVE[i + 1]
-            
-            if v2 <= voltage <= v1:
-                # Linear interpolation
-                ratio = (voltage - v2) / (v1 - v2)
-                return soc2 + ratio * (soc1 - soc2)
-        
-        return 50.0  # Default fallback
+        # VCELL is quantized to 1.25 mV, so key the cache on the step count
+        return expected_soc_for_step(round(voltage * VCELL_STEPS_PER_VOLT))
+    
+    def _median_voltage(self, voltage: float) -> float:
+        """Push a sample into the voltage history and return the median of the history"""
+        history = self.state['recent_voltages'][1:] + [voltage]
+        self.state['recent_voltages'] = history
+        # Empty slots (0.0) only exist until the history has filled after boot
+        samples = sorted(v for v in history if v > 0)
+        if not samples:
+            # Nothing usable yet (e.g. a 0 V read on fresh state) - judge this reading alone
+            return voltage
+        return samples[len(samples) // 2]
     
     def _is_bad_reading(self, voltage: float, soc: float) -> bool:
         """Check if reading deviates significantly from expected li-ion curve"""
@@ -203,14 +314,14 @@ class BatteryMonitor:
         
         is_bad = deviation > BAD_READING_THRESHOLD
         if is_bad:
-            self.logger.warning(f"Bad reading detected: {soc:.1f}% vs expected {expected_soc:.1f}% "
-                              f"(deviation: {deviation:.1%})")
+            self.logger.warning("Bad reading detected: %.1f%% vs expected %.1f%% (deviation: %.1f%%)",
+                                soc, expected_soc, deviation * 100)
         
         return is_bad
     
-    def _can_quick_start(self) -> bool:
+    def _can_quick_start(self, in_window: bool) -> bool:
         """Check if quick-start is allowed (not in cooldown or charging window)"""
-        current_time = time.time()
+        current_time = self._now
         last_quick_start = self.state.get('last_quick_start', 0)
         
         # Check cooldown period
@@ -218,7 +329,7 @@ class BatteryMonitor:
             return False
         
         # Never quick-start during charging window
-        if self._is_in_charging_window():
+        if in_window:
             return False
         
         return True
@@ -228,29 +339,48 @@ class BatteryMonitor:
         if not self._write_register16(MODE_REGISTER, QUICK_START_COMMAND):
             return False
         
-        self.state['last_quick_start'] = time.time()
+        self.state['last_quick_start'] = self._now
         self.logger.info("Quick-start command sent successfully")
         return True
     
-    def _read_battery_data(self) -> Optional[Dict[str, Any]]:
-        """Read battery data from MAX17043"""
-        vcell_raw = self._read_register16(VCELL_REGISTER)
-        soc_raw = self._read_register16(SOC_REGISTER)
+    def _wait_for_quick_start(self, old_soc: float, in_window: bool) -> Optional[Dict[str, Any]]:
+        """Re-read until the gauge reports a settled, recomputed SOC, up to QUICK_START_SETTLE
         
-        if vcell_raw is None or soc_raw is None:
+        A new SOC only counts once it has held for two consecutive reads after
+        QUICK_START_MIN_SETTLE; a one-LSB drift or a value caught mid-recompute doesn't.
+        """
+        start = time.monotonic()
+        data = None
+        previous = None
+        while time.monotonic() - start < QUICK_START_SETTLE:
+            time.sleep(QUICK_START_POLL)
+            data = self._read_battery_data(in_window)
+            soc = data['percent_raw'] if data else None
+            if (soc is not None and soc != old_soc and soc == previous
+                    and time.monotonic() - start >= QUICK_START_MIN_SETTLE):
+                break
+            previous = soc
+        return data
+    
+    def _read_battery_data(self, in_window: bool) -> Optional[Dict[str, Any]]:
+        """Read battery data from MAX17043"""
+        # VCELL and SOC are adjacent, so both come back in a single transaction
+        block = self._read_block(VCELL_REGISTER, SOC_REGISTER - VCELL_REGISTER + 2)
+        if block is None:
             return None
         
         # Convert raw values according to datasheet
+        vcell_raw = (block[0] << 8) | block[1]
         voltage = (vcell_raw >> 4) * 1.25 / 1000.0  # Convert to volts
-        soc_percent = (soc_raw >> 8) + (soc_raw & 0xFF) / 256.0  # High byte + fractional
+        soc_percent = block[2] + block[3] / 256.0  # High byte + fractional
         user_percent = min(100.0, max(0.0, (soc_percent - 10.0) * (100.0 / 90.0)))
         return {
             'voltage': voltage,
             'percent_user': user_percent,
             'percent_raw': soc_percent,
-            'timestamp': time.time(),
+            'timestamp': self._now,
             'charging': self._is_charging(),
-            'in_window': self._is_in_charging_window()
+            'in_window': in_window
         }
     
     def _write_status_file(self, battery_data: Dict[str, Any]):
@@ -258,87 +388,133 @@ class BatteryMonitor:
         try:
             status = {
                 'battery': battery_data,
-                'timestamp': time.time()
+                # Published in the same cycle as the reading, so share its clock read
+                'timestamp': battery_data.get('timestamp') or self._now
             }
+            payload = dump_json(status)
             
-            with open(STATUS_FILE, 'w') as f:
-                json.dump(status, f, indent=2)
+            # Write a temp file and rename over the old one so readers never see a partial file
+            replace_file(STATUS_FILE, payload, 0o644)
                 
         except OSError as e:
-            self.logger.error(f"Failed to write status file: {e}")
+            self.logger.error("Failed to write status file: %s", e)
     
-    def run(self) -> bool:
-        """Run single monitoring cycle"""
-        self.logger.info("Starting battery monitor")
-        
+    def _init_hardware(self) -> bool:
+        """Open the I2C bus and charge detect pin"""
         if not self._init_i2c():
             self.logger.error("Failed to initialize I2C")
             return False
         
         if not self._init_gpio():
             self.logger.error("Failed to initialize GPIO")
+        return True
+    
+    def run(self) -> bool:
+        """Run single monitoring cycle"""
+        self.logger.info("Starting battery monitor")
         
-        # Update charging state
-        self._update_charging_state()
-        
-        # Read battery data
-        battery_data = self._read_battery_data()
-        if battery_data is None:
-            self.logger.error("Failed to read battery data")
-            self._write_status_file({'error': 'Failed to read battery data'})
-            self._save_state()
+        if not self._init_hardware():
             return False
+        return self.run_once()
+    
+    def run_forever(self, period: float) -> bool:
+        """Run a cycle every period seconds, keeping the bus and state open"""
+        self.logger.info("Starting battery monitor daemon (every %.1fs)", period)
         
-        # Check for bad readings
-        is_bad = self._is_bad_reading(battery_data['voltage'], battery_data['percent_raw'])
-        in_window = self._is_in_charging_window()
-        
-        self.logger.info(f"Battery: {battery_data['percent_raw']:.1f}%, "
-                        f"{battery_data['voltage']:.3f}V, charging: {battery_data['charging']}, "
-                        f"window: {in_window}, bad_reading: {is_bad}")
-        
-        # Handle bad readings
-        if is_bad and not in_window:
-            if self._can_quick_start():
-                self.logger.warning("Bad reading detected outside window - sending quick-start")
-                self._send_quick_start()
-                # Wait for stabilization and re-read
-                time.sleep(2)
-                new_data = self._read_battery_data()
-                if new_data:
-                    battery_data = new_data
-            else:
-                self.logger.warning("Bad reading detected but quick-start not allowed")
-        elif is_bad and in_window:
-            self.logger.info("Bad reading detected during charging window - ignoring")
+        if not self._init_hardware():
+            return False
         
-        # Write status file
-        self._write_status_file(battery_data)
-        self._save_state()
+        # Cycles are pinned to a monotonic schedule so slow reads can't drift it
+        next_cycle = time.monotonic()
+        while True:
+            self.run_once()
+            next_cycle += period
+            time.sleep(max(0.0, next_cycle - time.monotonic()))
+    
+    def run_once(self) -> bool:
+        """Run one monitoring cycle on an initialized bus"""
+        # Charger state and wall time are sampled once per cycle, then shared by every check
+        self._charging = None
+        self._now = time.time()
         
-        return True
+        # State is saved once, on every path out of the cycle, and only if it changed.
+        # The voltage ring moves on nearly every read, so it doesn't count as a change
+        # on its own; it rides along with other writes and is flushed in cleanup().
+        initial_state = dict(self.state, recent_voltages=None)
+        try:
+            # Update charging state; the window can't change within one cycle
+            self._update_charging_state()
+            in_window = self._is_in_charging_window()
+            
+            # Read battery data
+            battery_data = self._read_battery_data(in_window)
+            if battery_data is None:
+                self.logger.error("Failed to read battery data")
+                self._write_status_file({'error': 'Failed to read battery data'})
+                return False
+            
+            # Check for bad readings
+            # A single glitched voltage sample shouldn't be able to trigger a quick-start
+            baseline = self._median_voltage(battery_data['voltage'])
+            is_bad = self._is_bad_reading(baseline, battery_data['percent_raw'])
+            
+            self.logger.info("Battery: %.1f%%, %.3fV, charging: %s, window: %s, bad_reading: %s",
+                             battery_data['percent_raw'], battery_data['voltage'],
+                             battery_data['charging'], in_window, is_bad)
+            
+            # Handle bad readings
+            if is_bad and not in_window:
+                if self._can_quick_start(in_window):
+                    self.logger.warning("Bad reading detected outside window - sending quick-start")
+                    self._send_quick_start()
+                    new_data = self._wait_for_quick_start(battery_data['percent_raw'], in_window)
+                    if new_data:
+                        battery_data = new_data
+                else:
+                    self.logger.warning("Bad reading detected but quick-start not allowed")
+            elif is_bad and in_window:
+                self.logger.info("Bad reading detected during charging window - ignoring")
+            
+            # Write status file
+            self._write_status_file(battery_data)
+            
+            return True
+        finally:
+            if dict(self.state, recent_voltages=None) != initial_state:
+                self._save_state()
     
     def cleanup(self):
         """Cleanup resources"""
-        if self.gpio_ready:
+        if self.state['recent_voltages'] != self._saved_voltages:
+            self._save_state()
+        
+        if self.gpio_handle is not None:
             try:
-                GPIO.cleanup()
-            except:
+                lgpio.gpiochip_close(self.gpio_handle)
+            except lgpio.error:
                 pass
+            self.gpio_handle = None
+            self._read_charge = _no_charger
 
 
 def main():
     monitor = BatteryMonitor()
     
     try:
-        success = monitor.run()
+        if len(sys.argv) > 1 and sys.argv[1] == '--daemon':
+            period = float(sys.argv[2]) if len(sys.argv) > 2 else DAEMON_PERIOD
+            # Exit through finally so the GPIO handle is released and logs flushed
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            success = monitor.run_forever(period)
+        else:
+            success = monitor.run()
         return 0 if success else 1
         
     except KeyboardInterrupt:
         monitor.logger.info("Interrupted by user")
         return 0
     except Exception as e:
-        monitor.logger.error(f"Unexpected error: {e}")
+        monitor.logger.error("Unexpected error: %s", e)
         return 1
     finally:
         monitor.cleanup()
@@ -6,22 +6,52 @@ Reads battery data from JSON file written by battery monitor script
 
 import json
 import datetime
+import logging
 import time
 import os
-from collections import deque
-from typing import Optional, Dict
+import sys
+import queue
+import threading
+from typing import Optional, Dict, Set
 import gi
 
 gi.require_version('Gtk', '3.0')
 gi.require_version('AyatanaAppIndicator3', '0.1')
 
-from gi.repository import Gtk, GLib, AyatanaAppIndicator3 as AppIndicator3
+from gi.repository import Gtk, GLib, Gio, AyatanaAppIndicator3 as AppIndicator3
+
+try:
+    import smbus2 as smbus
+except ImportError:
+    import smbus
+
+try:
+    import orjson
+    load_json = orjson.loads
+except ImportError:
+    _decode_json = json.JSONDecoder().decode
+    
+    def load_json(data):
+        return _decode_json(str(data, 'utf-8'))
 
 STATUS_FILE = '/tmp/battery_status.json'
+BACKUP_INTERVAL = 30  # Seconds between liveness reads while the file monitor is active
+
+STATUS_READ_SIZE = 4096  # Status read buffer size; the status file is a few hundred bytes
+STALE_AGE = 10  # Seconds before the status file is considered stale
+RATE_SPAN = 60  # Seconds between discharge rate samples
+RATE_ALPHA = 0.3  # Weight of the newest rate sample in the moving average
+
+# Fuel gauge, read directly when the monitor stops publishing
+I2C_BUS = 3
+MAX17043_ADDRESS = 0x36
+VCELL_REGISTER = 0x02
+
+logger = logging.getLogger('BatteryWidget')
 
 class IconManager:
     """Efficient icon management with comprehensive caching"""
-    __slots__ = ('_icon_cache', '_theme', '_theme_ready', '_level_cache')
+    __slots__ = ('_icon_names', '_theme', '_theme_ready', '_resolved')
     
     # Static icon definitions - no repeated string formatting
     _CHARGING_TEMPLATES = (
@@ -49,11 +79,15 @@ class IconManager:
         "battery-good-symbolic",
     )
     
+    # Icon level for every 0.1% step, indexed by int(percentage * 10); each entry is
+    # rounded from its band's midpoint so only exact ties (e.g. 5.0%) differ from round()
+    _LEVEL_LUT = tuple(max(0, min(100, int(round((i + 0.5) / 100) * 10))) for i in range(1001))
+    
     def __init__(self):
-        self._icon_cache: Dict[str, bool] = {}
+        self._icon_names: Optional[Set[str]] = None  # Every icon the theme provides
         self._theme = None
         self._theme_ready = False
-        self._level_cache = {}  # Cache percentage->level conversions
+        self._resolved: Dict[tuple, str] = {}  # (level, charging) -> icon name
     
     def _get_theme(self) -> Optional[Gtk.IconTheme]:
         """Get theme instance with caching"""
@@ -72,23 +106,18 @@ class IconManager:
         return self._theme_ready
     
     def _test_icon(self, icon_name: str) -> bool:
-        """Test icon existence with caching"""
-        if icon_name in self._icon_cache:
-            return self._icon_cache[icon_name]
-        
-        theme = self._get_theme()
-        exists = theme and theme.has_icon(icon_name)
-        self._icon_cache[icon_name] = exists
-        return exists
+        """Test icon existence against the theme's icon list"""
+        if self._icon_names is None:
+            # One call into GTK for the whole theme instead of one has_icon per name
+            theme = self._get_theme()
+            self._icon_names = set(theme.list_icons(None)) if theme else set()
+        return icon_name in self._icon_names
     
-    def _get_level(self, percentage: float) -> int:
-        """Get battery level with caching"""
-        if percentage in self._level_cache:
-            return self._level_cache[percentage]
-        
-        level = max(0, min(100, int(round(percentage / 10) * 10)))
-        self._level_cache[percentage] = level
-        return level
+    def reset(self) -> None:
+        """Forget everything learned about the current theme"""
+        self._icon_names = None
+        self._resolved.clear()
+        self._theme_ready = False
     
     def _find_icon(self, templates: tuple, level: int) -> Optional[str]:
         """Find first working icon from templates"""
@@ -107,8 +136,14 @@ class IconManager:
         if not self._theme_ready:
             return "battery-good-symbolic"
         
-        level = self._get_level(percentage)
-        
+        key = (self._LEVEL_LUT[min(1000, max(0, int(percentage * 10)))], is_charging)
+        icon = self._resolved.get(key)
+        if icon is None:
+            icon = self._resolved[key] = sys.intern(self._resolve_icon(*key))
+        return icon
+    
+    def _resolve_icon(self, level: int, is_charging: bool) -> str:
+        """Pick the best available icon for a level and charging state"""
         # Handle 100% battery with dedicated icons
         if level == 100:
             icons = self._FULL_CHARGING if is_charging else self._FULL_NORMAL
@@ -134,22 +169,19 @@ class IconManager:
         
         return "battery-good-symbolic"
     
-    def preload_icons(self):
+    def preload_icons(self) -> None:
         """Preload common icons efficiently"""
         if not self._theme_ready:
             return
         
-        # Batch test common levels
-        levels = range(0, 101, 10)
-        all_templates = self._CHARGING_TEMPLATES + self._NORMAL_TEMPLATES
-        
-        for level in levels:
-            for template in all_templates:
-                self._test_icon(template.format(level))
-        
-        # Test special icons
-        for icon in self._FULL_CHARGING + self._FULL_NORMAL + self._FALLBACKS:
-            self._test_icon(icon)
+        # Resolve every level/charging pair once; lookups are then a single dict get
+        for level in range(0, 101, 10):
+            for is_charging in (False, True):
+                self._resolved[(level, is_charging)] = sys.intern(self._resolve_icon(level, is_charging))
+
+
+# Shared by every indicator in the process so the theme is only probed once
+ICON_MANAGER = IconManager()
 
 
 class BatterySystemTray:
@@ -157,8 +189,10 @@ class BatterySystemTray:
     __slots__ = (
         'update_interval', 'current_battery', 'was_charging',
         'initialization_complete', 'icon_manager', 'indicator',
-        'status_item', 'runtime_item', 'battery_history', 'last_runtime_estimate',
-        'last_timestamp', 'file_mtime', 'cached_battery_data', 'reading_count'
+        'status_item', 'runtime_item', 'rate_anchor', 'discharge_rate', 'last_runtime_estimate',
+        'last_timestamp', 'file_mtime', 'cached_battery_data', 'reading_count',
+        'status_monitor', 'bus', 'last_icon', 'last_status_text', 'last_runtime_text',
+        'status_cache', 'display_key', 'read_requests', 'read_buf'
     )
     
     def __init__(self):
@@ -176,18 +210,45 @@ class BatterySystemTray:
         self.file_mtime = 0
         self.cached_battery_data = None
         
-        # Battery history with efficient deque
-        self.battery_history = deque(maxlen=10)
+        # Last values pushed to the panel, so unchanged ones aren't re-sent over D-Bus
+        self.last_icon = None
+        self.last_status_text = None
+        self.last_runtime_text = None
+        self.status_cache = (None, "")  # (display key, formatted status text)
+        self.display_key = None  # Everything the last applied display was built from
+        
+        # Discharge rate as a moving average of samples taken RATE_SPAN apart
+        self.rate_anchor = None  # (percent, timestamp) the next sample is measured from
+        self.discharge_rate = 0.0  # %/hour
         self.last_runtime_estimate = "Calculating..."
         self.last_timestamp = 0
         
+        # Direct fuel gauge access for when the status file goes stale
+        try:
+            self.bus = smbus.SMBus(I2C_BUS)
+        except OSError:
+            self.bus = None
+        
+        # File and I2C reads happen on a worker so a slow read can't stall the UI
+        self.read_requests = queue.SimpleQueue()
+        self.read_buf = bytearray(STATUS_READ_SIZE)  # Reused by every status read (worker only)
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        
         # Initialize components
-        self.icon_manager = IconManager()
+        self.icon_manager = ICON_MANAGER
         self._setup_indicator()
         
-        # Start efficient polling
-        GLib.timeout_add(500, self._check_theme_ready)
-        GLib.timeout_add(self.update_interval, self._update_battery)
+        # Initialize icons as soon as the theme has loaded, and again if it changes
+        theme = Gtk.IconTheme.get_default()
+        theme.connect("changed", self._on_theme_changed)
+        self._check_theme_ready()
+        
+        # Update when the monitor publishes; only poll if the file can't be watched
+        self.status_monitor = self._setup_status_monitor()
+        if self.status_monitor:
+            GLib.timeout_add_seconds(BACKUP_INTERVAL, self._update_battery)
+        else:
+            GLib.timeout_add(self.update_interval, self._update_battery)
     
     def _setup_indicator(self):
         """Setup AppIndicator with minimal initialization"""
@@ -227,28 +288,81 @@ class BatterySystemTray:
         menu.show()
         self.indicator.set_menu(menu)
     
-    def _read_battery_data(self) -> Optional[Dict]:
-        """Read battery data from JSON file with caching"""
+    def _setup_status_monitor(self) -> Optional[Gio.FileMonitor]:
+        """Watch the status file for new data"""
         try:
-            # Check if file exists
-            if not os.path.exists(STATUS_FILE):
-                return None
-                
-            # Check if file was modified
-            mtime = os.path.getmtime(STATUS_FILE)
-            if mtime == self.file_mtime and self.cached_battery_data:
-                return self.cached_battery_data
+            monitor = Gio.File.new_for_path(STATUS_FILE).monitor_file(
+                Gio.FileMonitorFlags.NONE, None)
+        except GLib.Error:
+            return None
+        monitor.connect("changed", self._on_status_changed)
+        return monitor
+    
+    def _on_status_changed(self, monitor: Gio.FileMonitor, file: Gio.File,
+                           other_file: Optional[Gio.File], event_type: Gio.FileMonitorEvent) -> None:
+        """Refresh once a write (or rename into place) has completed"""
+        if event_type == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
+            self._update_battery(changed=True)
+    
+    def _read_battery_data(self, changed: bool = False) -> Optional[Dict]:
+        """Read battery data, going to the fuel gauge if the status file is stale"""
+        battery = self._read_status_file(changed)
+        if battery is None or time.time() - battery.get('timestamp', 0) > STALE_AGE:
+            return self._read_battery_direct(battery) or battery
+        return battery
+    
+    def _read_battery_direct(self, last: Optional[Dict]) -> Optional[Dict]:
+        """Read VCELL and SOC from the MAX17043 in one block read"""
+        if self.bus is None:
+            return None
+        try:
+            block = self.bus.read_i2c_block_data(MAX17043_ADDRESS, VCELL_REGISTER, 4)
+        except OSError:
+            return None
+        
+        voltage = (((block[0] << 8) | block[1]) >> 4) * 1.25 / 1000.0
+        soc_percent = block[2] + block[3] / 256.0
+        return {
+            'voltage': voltage,
+            'percent_user': min(100.0, max(0.0, (soc_percent - 10.0) * (100.0 / 90.0))),
+            'percent_raw': soc_percent,
+            'timestamp': time.time(),
+            # The charge pin belongs to the monitor; keep its last answer
+            'charging': bool(last and last.get('charging', False))
+        }
+    
+    def _read_status_file(self, changed: bool = False) -> Optional[Dict]:
+        """Read battery data from JSON file with caching
+        
+        changed=True means the file monitor saw a new write, so the mtime check is skipped.
+        """
+        try:
+            mtime = None
+            size = 0
+            if not changed:
+                # Check if file was modified (integer ns, no float equality)
+                st = os.stat(STATUS_FILE)
+                if st.st_mtime_ns == self.file_mtime and self.cached_battery_data:
+                    return self.cached_battery_data
+                mtime, size = st.st_mtime_ns, st.st_size
+            
+            if size > len(self.read_buf):
+                self.read_buf = bytearray(size)
             
-            # Read and parse JSON file
-            with open(STATUS_FILE, 'r') as f:
-                data = json.load(f)
+            # Read into the reused buffer in one call; the file is replaced by rename, so no kept fd
+            fd = os.open(STATUS_FILE, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                length = os.readv(fd, (self.read_buf,))
+            finally:
+                os.close(fd)
+            data = load_json(memoryview(self.read_buf)[:length])
             
             # Cache the data
             self.file_mtime = mtime
             self.cached_battery_data = data.get('battery')
             return self.cached_battery_data
             
-        except (FileNotFoundError, KeyError, json.JSONDecodeError, OSError):
+        except (FileNotFoundError, KeyError, ValueError, OSError):
             return None
     
     def _calculate_runtime(self) -> str:
@@ -257,36 +371,40 @@ class BatterySystemTray:
             return self.last_runtime_estimate
         
         current_percent = self.current_battery['percent_user']
-        current_time = self.current_battery.get('timestamp', time.time())
+        current_time = self.current_battery.get('timestamp', 0)
         
-        # Skip if no new data
+        # Skip if no new data (or no timestamp to measure a rate against)
         if current_time <= self.last_timestamp:
             return self.last_runtime_estimate
         
-        # Add to history
-        self.battery_history.append((current_percent, current_time))
         self.last_timestamp = current_time
         
-        # Need at least 2 readings
-        if len(self.battery_history) < 2:
+        # First reading becomes the anchor
+        if self.rate_anchor is None:
+            self.rate_anchor = (current_percent, current_time)
             return self.last_runtime_estimate
         
-        # Calculate discharge rate using oldest and newest readings
-        old_percent, old_time = self.battery_history[0]
+        old_percent, old_time = self.rate_anchor
         time_span = current_time - old_time
         percent_change = old_percent - current_percent
         
-        # Reset history if battery level increased (charging detected)
+        # Reset if battery level increased (charging detected)
         if percent_change < 0:
-            self.battery_history.clear()
+            self._reset_runtime(current_percent, current_time)
             return "Calculating..."
         
-        # Validate discharge data
-        if time_span < 60 or percent_change <= 0:
+        # Take a new rate sample once the anchor is far enough back to be meaningful
+        if time_span < RATE_SPAN:
             return self.last_runtime_estimate
         
-        discharge_rate = (percent_change / time_span) * 3600
+        rate = (percent_change / time_span) * 3600
+        if self.discharge_rate:
+            self.discharge_rate += RATE_ALPHA * (rate - self.discharge_rate)
+        else:
+            self.discharge_rate = rate
+        self.rate_anchor = (current_percent, current_time)
         
+        discharge_rate = self.discharge_rate
         if discharge_rate < 0.5:
             return "Calculating..."
         
@@ -303,88 +421,139 @@ class BatterySystemTray:
         
         return self.last_runtime_estimate
     
-    def _check_theme_ready(self) -> bool:
+    def _reset_runtime(self, percent: Optional[float] = None, timestamp: float = 0.0) -> None:
+        """Forget the discharge rate, optionally re-anchoring at a reading"""
+        self.rate_anchor = (percent, timestamp) if percent is not None else None
+        self.discharge_rate = 0.0
+    
+    def _check_theme_ready(self) -> None:
         """Check theme readiness and initialize"""
         if self.icon_manager.check_theme_ready() and not self.initialization_complete:
             # Theme ready - initialize immediately
             self.icon_manager.preload_icons()
             self.initialization_complete = True
-            return False  # Stop polling
-        
-        return True  # Continue polling
     
-    def _update_display(self):
+    def _on_theme_changed(self, theme: Gtk.IconTheme) -> None:
+        """Re-resolve icons against the new theme"""
+        self.icon_manager.reset()
+        if self.icon_manager.check_theme_ready():
+            self.icon_manager.preload_icons()
+            self.initialization_complete = True
+        # Force the next display update to push the icon again
+        self.last_icon = None
+        self.display_key = None
+    
+    def _update_display(self) -> None:
         """Update icon and menu items efficiently"""
         battery = self.current_battery
         
+        if not battery or 'error' in battery:
+            # Error labels replace the last display; rebuild it when data returns
+            self.display_key = None
+        
         if not battery:
-            self.status_item.set_label("Battery: Error")
-            self.runtime_item.set_label("Runtime: Unknown")
+            self._set_labels("Battery: Error", "Runtime: Unknown")
             return
         
         # Check for battery errors
         if 'error' in battery:
-            self.status_item.set_label(f"Battery: {battery['error']}")
-            self.runtime_item.set_label("Runtime: Unknown")
+            self._set_labels(f"Battery: {battery['error']}", "Runtime: Unknown")
             return
         
         percentage = battery['percent_user']
         voltage = battery['voltage']
         charging = battery.get('charging', False)
-        
-        # Update icon
+        runtime = None if charging else self._calculate_runtime()
         icon_name = self.icon_manager.get_battery_icon(percentage, charging)
-        self.indicator.set_icon(icon_name)
         
-        # Update menu items
-        status_text = f"Battery: {percentage:.0f}% ({voltage:.2f}V)"
-        if charging:
-            status_text += " - Charging"
+        # Nothing visible changed since the last update - leave GTK alone
+        status_key = (round(percentage), round(voltage, 2), charging)
+        display_key = (icon_name, status_key, runtime)
+        if display_key == self.display_key:
+            return
+        self.display_key = display_key
+        
+        # Update icon
+        if icon_name != self.last_icon:
+            self.indicator.set_icon(icon_name)
+            self.last_icon = icon_name
+        
+        # Update menu items, formatting only when the displayed values change
+        cached_key, status_text = self.status_cache
+        if status_key != cached_key:
+            status_text = f"Battery: {percentage:.0f}% ({voltage:.2f}V)"
+            if charging:
+                status_text += " - Charging"
+            self.status_cache = (status_key, status_text)
         
         if charging:
             runtime_text = "Runtime: ---"
         else:
-            runtime_text = f"Runtime: {self._calculate_runtime()}"
+            runtime_text = f"Runtime: {runtime}"
         
-        self.status_item.set_label(status_text)
-        self.runtime_item.set_label(runtime_text)
+        self._set_labels(status_text, runtime_text)
+    
+    def _set_labels(self, status_text: str, runtime_text: str) -> None:
+        """Update menu labels, skipping ones that haven't changed"""
+        if status_text != self.last_status_text:
+            self.status_item.set_label(status_text)
+            self.last_status_text = status_text
+        if runtime_text != self.last_runtime_text:
+            self.runtime_item.set_label(runtime_text)
+            self.last_runtime_text = runtime_text
     
-    def _update_battery(self) -> bool:
-        """Main update timer callback"""
+    def _update_battery(self, changed: bool = False) -> bool:
+        """Main update callback (file monitor or timer)"""
+        if not self.initialization_complete:
+            # Covers a theme that was already loaded without emitting "changed"
+            self._check_theme_ready()
         if self.initialization_complete:
-            self.reading_count += 1
+            self.read_requests.put(changed)
+        
+        return True
+    
+    def _read_loop(self) -> None:
+        """Worker thread: read battery data on request and hand it to the main loop"""
+        while True:
+            changed = self.read_requests.get()
+            try:
+                battery = self._read_battery_data(changed)
+                GLib.idle_add(self._apply_battery_data, battery)
+            except Exception:
+                # Keep the worker alive; the next request retries from scratch
+                logger.exception("Battery read failed")
+    
+    def _apply_battery_data(self, battery: Optional[Dict]) -> bool:
+        """Apply a reading to the UI (main thread)"""
+        self.reading_count += 1
+        if battery and 'error' not in battery:
+            # Update current battery data
+            self.current_battery = battery
+            charging = battery.get('charging', False)
             
-            # Read battery data from JSON file
-            battery = self._read_battery_data()
-            if battery and 'error' not in battery:
-                # Update current battery data
-                self.current_battery = battery
-                charging = battery.get('charging', False)
-                
-                # Handle charger state changes for runtime reset
-                if self.was_charging and not charging:
-                    self.battery_history.clear()
-                    self.last_runtime_estimate = "Calculating..."
-                self.was_charging = charging
-                
-                # Always update runtime calculation (builds history)
-                if not charging:
-                    self._calculate_runtime()
-                
-                # Update display based on reading count
-                if self.reading_count >= 2:
-                    # Normal display updates after second reading
-                    self._update_display()
-                elif self.reading_count == 1:
-                    # First reading - show minimal info while waiting for accuracy
-                    self.status_item.set_label("Battery: Reading...")
-                    self.runtime_item.set_label("Runtime: Calculating...")
-            else:
-                # Error case - update display immediately
-                self.current_battery = battery
+            # Handle charger state changes for runtime reset
+            if self.was_charging and not charging:
+                self._reset_runtime()
+                self.last_runtime_estimate = "Calculating..."
+            self.was_charging = charging
+            
+            # Always update runtime calculation (builds history)
+            if not charging:
+                self._calculate_runtime()
+            
+            # Update display based on reading count
+            if self.reading_count >= 2:
+                # Normal display updates after second reading
                 self._update_display()
+            elif self.reading_count == 1:
+                # First reading - show minimal info while waiting for accuracy
+                self._set_labels("Battery: Reading...", "Runtime: Calculating...")
+        else:
+            # Error case - update display immediately
+            self.current_battery = battery
+            self._update_display()
         
-        return True
+        return False
     
     def _show_details(self, widget):
         """Show detailed battery information"""
@@ -434,6 +603,10 @@ class BatterySystemTray:
 
 def main():
     """Application entry point"""
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
     try:
         tray = BatterySystemTray()
         Gtk.main()
@@ -22,10 +22,11 @@ apt install -y \
     gir1.2-gtk-3.0 \
     libayatana-appindicator3-1 \
     gir1.2-ayatanaappindicator3-0.1 \
-    python3-rpi.gpio \
+    python3-lgpio \
     python3-smbus \
     python3-dbus \
     zenity \
+    libnotify-bin \
     jq \
     adwaita-icon-theme \
     gnome-icon-theme-symbolic
@@ -46,6 +47,7 @@ wget -O /usr/local/bin/battery-widget.py "$BASE_URL/battery-widget.py"
 
 # Download systemd service files
 wget -O /etc/systemd/system/battery-alert.service "$BASE_URL/battery-alert.service"
+wget -O /etc/systemd/system/battery-monitor.service "$BASE_URL/battery-monitor.service"
 wget -O /etc/systemd/system/battery-oneshot.service "$BASE_URL/battery-oneshot.service"
 wget -O /etc/systemd/system/battery-oneshot.timer "$BASE_URL/battery-oneshot.timer"
 
@@ -70,10 +72,10 @@ wget -O /usr/share/applications/battery-widget.desktop "$BASE_URL/usrshareapps-b
 echo ""
 echo "Setting up systemd services..."
 systemctl daemon-reload
+systemctl enable battery-monitor.service
 systemctl enable battery-alert.service
-systemctl enable battery-oneshot.timer
+systemctl start battery-monitor.service
 systemctl start battery-alert.service
-systemctl start battery-oneshot.timer
 
 echo ""
 echo "Downloading display overlay..."
@@ -99,7 +101,7 @@ cat > /boot/firmware/config.txt << 'EOF'
 # GPIO 18 - Backlight PWM
 
 dtparam=audio=off
-dtoverlay=i2c-gpio,bus=3,i2c_gpio_sda=23,i2c_gpio_scl=24
+dtoverlay=i2c-gpio,bus=3,i2c_gpio_sda=23,i2c_gpio_scl=24,i2c_gpio_delay_us=1
 dtoverlay=gpio-shutdown
 dtoverlay=pwm-gpio-fan,fan_gpio=27
 dtoverlay=vc4-kms-v3d
@@ -116,7 +118,7 @@ echo "Installation complete!"
 echo ""
 echo "Services installed and started:"
 echo "  - battery-alert.service (critical battery shutdown)"
-echo "  - battery-oneshot.timer (battery data collection)"
+echo "  - battery-monitor.service (battery data collection)"
 echo "  - battery-widget (desktop app - will start on next login)"
 echo ""
 echo "Configuration backed up to: /boot/firmware/config.txt.backup"
@@ -7,23 +7,124 @@ Optimized for minimal CPU usage with async event handling
 """
 
 import asyncio
+import ctypes
 import evdev
-import RPi.GPIO as GPIO
+import lgpio
 import json
+import logging
+import struct
+import sys
 import time
 import os
 from contextlib import asynccontextmanager
 from typing import Optional
 
+try:
+    import orjson
+    load_json = orjson.loads
+except ImportError:
+    _decode_json = json.JSONDecoder().decode
+    
+    def load_json(data: bytes):
+        return _decode_json(data.decode())
+
+try:
+    import uvloop
+    new_event_loop = uvloop.new_event_loop
+except ImportError:
+    new_event_loop = None  # asyncio's default loop
+
 # Configuration
+GPIO_CHIP = 0  # /dev/gpiochip0
 CAPS_LED_PIN = 5
 BATTERY_LED_PIN = 6
-BATTERY_CHECK_INTERVAL = 30  # seconds
+BATTERY_CHECK_INTERVAL = 30  # seconds, polling default if inotify is unavailable
+BATTERY_CHECK_FAST = 15  # seconds, polling near the low threshold
+BATTERY_CHECK_MID = 60  # seconds, polling while clear of the threshold
+BATTERY_CHECK_SLOW = 300  # seconds, polling while the level is high and steady
+BATTERY_STEADY_LEVEL = 40.0  # percent above which a steady level is polled slowly
+BATTERY_NEAR_MARGIN = 5.0  # percent above the low threshold that counts as near it
+BATTERY_SAFETY_INTERVAL = 300  # seconds without a publish before a forced re-read
 BATTERY_LOW_THRESHOLD = 15.0  # percent
 BATTERY_STATUS_FILE = '/tmp/battery_status.json'
 MAX_DATA_AGE = 300  # seconds (5 minutes)
+KEYBOARD_RETRY_DELAY = 1  # seconds, doubled after each consecutive keyboard error
+KEYBOARD_RETRY_MAX = 30  # seconds
+INPUT_DIR = '/dev/input'
+INPUT_SYSFS = '/sys/class/input'
 DEBUG = False
 
+# Debug messages are only formatted when DEBUG enables them
+logging.basicConfig(
+    level=logging.DEBUG if DEBUG else logging.WARNING,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# inotify (linux/inotify.h), used to wake on status publishes and keyboard hotplug
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (name follows)
+
+# Raw evdev records (linux/input.h struct input_event), native long matches the kernel's timeval
+INPUT_EVENT = struct.Struct('llHHi')  # sec, usec, type, code, value
+INPUT_READ_SIZE = INPUT_EVENT.size * 64
+EV_KEY = evdev.ecodes.EV_KEY
+KEY_CAPSLOCK = evdev.ecodes.KEY_CAPSLOCK
+KEY_PRESS = 1  # input_event value for a key going down (0 = up, 2 = autorepeat)
+
+# type, code and value fill the last 8 bytes of each record, so a Caps Lock press
+# is one 64-bit word that can be matched without unpacking the record
+INPUT_WORDS = INPUT_EVENT.size // 8
+CAPS_PRESS_WORD = int.from_bytes(struct.pack('HHi', EV_KEY, KEY_CAPSLOCK, KEY_PRESS), sys.byteorder)
+
+# sysfs capability bitmaps are printed as kernel longs, most significant word first
+LONG_BITS = struct.calcsize('l') * 8
+
+def inotify_watch(path: str, mask: int) -> int:
+    """Open a non-blocking inotify fd watching a directory"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        err = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(err, "inotify_add_watch failed")
+    return fd
+
+def has_caps_lock_key(path: str) -> Optional[bool]:
+    """Check an input device's key capabilities in sysfs without opening it
+    
+    Returns None if sysfs can't answer, in which case the device has to be opened.
+    """
+    caps_file = os.path.join(INPUT_SYSFS, os.path.basename(path), 'device', 'capabilities', 'key')
+    try:
+        with open(caps_file) as f:
+            words = f.read().split()
+        bitmap = 0
+        for word in words:
+            bitmap = (bitmap << LONG_BITS) | int(word, 16)
+    except (OSError, ValueError):
+        return None
+    return bool((bitmap >> KEY_CAPSLOCK) & 1)
+
+def read_inotify_names(fd: int) -> list:
+    """Drain pending inotify events and return the file names they refer to"""
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            names.append(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
 class DualLEDController:
     def __init__(self, caps_pin: int, battery_pin: int):
         self.caps_pin = caps_pin
@@ -31,78 +132,133 @@ class DualLEDController:
         self.caps_state = False
         self.battery_low = False
         self.keyboard: Optional[evdev.InputDevice] = None
+        # (mtime_ns, size, percent, monotonic time the reading goes stale)
+        self._batt_cache: tuple = (None, None, None, 0.0)
+        self._last_percent: Optional[float] = None
         
-        # GPIO setup
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.caps_pin, GPIO.OUT)
-        GPIO.setup(self.battery_pin, GPIO.OUT)
-        GPIO.output(self.caps_pin, GPIO.LOW)
-        GPIO.output(self.battery_pin, GPIO.LOW)
+        # GPIO setup through the gpiochip character device, both LEDs claimed low
+        self.gpio = lgpio.gpiochip_open(GPIO_CHIP)
+        lgpio.gpio_claim_output(self.gpio, self.caps_pin, 0)
+        lgpio.gpio_claim_output(self.gpio, self.battery_pin, 0)
+        self._pin_state = {caps_pin: False, battery_pin: False}  # Last level driven on each LED
     
     def find_keyboard(self) -> Optional[evdev.InputDevice]:
         """Find USB keyboard device with Caps Lock capability"""
         if self.keyboard and not self.keyboard.closed:
             return self.keyboard
-            
-        devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
         
-        for device in devices:
-            caps = device.capabilities()
-            if (evdev.ecodes.EV_KEY in caps and 
-                evdev.ecodes.KEY_CAPSLOCK in caps[evdev.ecodes.EV_KEY]):
-                if DEBUG:
-                    print(f"Found keyboard: {device.name}")
-                self.keyboard = device
+        for path in evdev.list_devices():
+            device = self.probe_keyboard(path)
+            if device:
                 return device
         
         return None
     
+    def probe_keyboard(self, path: str) -> Optional[evdev.InputDevice]:
+        """Open one input device and keep it if it has a Caps Lock key"""
+        # Rule devices out from sysfs so only candidate keyboards are opened
+        if has_caps_lock_key(path) is False:
+            return None
+        
+        try:
+            device = evdev.InputDevice(path)
+        except OSError:
+            # Gone already, or udev hasn't applied permissions yet
+            return None
+        
+        caps = device.capabilities()
+        if EV_KEY in caps and KEY_CAPSLOCK in caps[EV_KEY]:
+            logging.debug("Found keyboard: %s", device.name)
+            self.keyboard = device
+            return device
+        
+        device.close()
+        return None
+    
+    async def wait_for_keyboard(self) -> evdev.InputDevice:
+        """Find a keyboard, waiting for one to be plugged in if none is present"""
+        try:
+            # udev creates the node, then fixes its permissions (IN_ATTRIB)
+            fd = inotify_watch(INPUT_DIR, IN_CREATE | IN_ATTRIB)
+        except (OSError, AttributeError) as e:
+            keyboard = self.find_keyboard()
+            if not keyboard:
+                raise RuntimeError("No compatible keyboard found") from e
+            return keyboard
+        
+        loop = asyncio.get_running_loop()
+        added = asyncio.Event()
+        loop.add_reader(fd, added.set)
+        try:
+            # Scan once with the watch in place so a keyboard added meanwhile isn't missed
+            keyboard = self.find_keyboard()
+            while not keyboard:
+                await added.wait()
+                added.clear()
+                # Only the devices that just appeared are opened
+                for name in read_inotify_names(fd):
+                    if name.startswith(b'event'):
+                        keyboard = self.probe_keyboard(os.path.join(INPUT_DIR, name.decode()))
+                        if keyboard:
+                            break
+            return keyboard
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+    
+    def _set_pin(self, pin: int, on: bool) -> None:
+        """Drive an LED pin, skipping the write if it is already at that level"""
+        if self._pin_state[pin] == on:
+            return
+        self._pin_state[pin] = on
+        lgpio.gpio_write(self.gpio, pin, 1 if on else 0)
+    
     def toggle_caps_led(self) -> None:
         """Toggle Caps Lock LED state"""
         self.caps_state = not self.caps_state
-        GPIO.output(self.caps_pin, GPIO.HIGH if self.caps_state else GPIO.LOW)
+        self._set_pin(self.caps_pin, self.caps_state)
         
-        if DEBUG:
-            print(f"Caps Lock {'ON' if self.caps_state else 'OFF'}")
+        logging.debug("Caps Lock %s", 'ON' if self.caps_state else 'OFF')
     
     def read_battery_level(self) -> Optional[float]:
         """Read battery level from status JSON file"""
         try:
-            if not os.path.exists(BATTERY_STATUS_FILE):
-                if DEBUG:
-                    print(f"Battery status file not found: {BATTERY_STATUS_FILE}")
-                return None
+            st = os.stat(BATTERY_STATUS_FILE)
             
-            with open(BATTERY_STATUS_FILE, 'r') as f:
-                data = json.load(f)
+            # Unchanged file: reuse the last parse until it ages out
+            mtime_ns, size, user_percent, stale_at = self._batt_cache
+            if (st.st_mtime_ns, st.st_size) != (mtime_ns, size):
+                with open(BATTERY_STATUS_FILE, 'rb') as f:
+                    # Key the cache on the file actually read, in case it was replaced since the stat
+                    st = os.fstat(f.fileno())
+                    data = load_json(f.read())
+                
+                # Age is measured once against the wall clock, then tracked monotonically
+                battery_info = data.get('battery', {})
+                data_age = time.time() - battery_info.get('timestamp', 0)
+                stale_at = time.monotonic() + MAX_DATA_AGE - data_age
+                user_percent = battery_info.get('percent_user')
+                self._batt_cache = (st.st_mtime_ns, st.st_size, user_percent, stale_at)
             
             # Check if data is recent enough
-            current_time = int(time.time())
-            data_timestamp = data.get('battery', {}).get('timestamp', 0)
-            
-            if current_time - data_timestamp > MAX_DATA_AGE:
-                if DEBUG:
-                    print(f"Battery data is stale (age: {current_time - data_timestamp}s)")
+            if time.monotonic() > stale_at:
+                logging.debug("Battery data is stale (older than %ds)", MAX_DATA_AGE)
                 return None
             
-            # Extract user percentage
-            battery_info = data.get('battery', {})
-            user_percent = battery_info.get('percent_user')
-            
             if user_percent is None:
-                if DEBUG:
-                    print("No percent_user field in battery data")
+                logging.debug("No percent_user field in battery data")
                 return None
                 
             return float(user_percent)
             
+        except FileNotFoundError:
+            logging.debug("Battery status file not found: %s", BATTERY_STATUS_FILE)
+            return None
         except (json.JSONDecodeError, ValueError, KeyError) as e:
-            if DEBUG:
-                print(f"Battery data parsing error: {e}")
+            logging.debug("Battery data parsing error: %s", e)
             return None
         except Exception as e:
-            if DEBUG:
-                print(f"Battery file read error: {e}")
+            logging.debug("Battery file read error: %s", e)
             return None
     
     def update_battery_led(self, battery_level: Optional[float]) -> None:
@@ -114,50 +270,125 @@ class DualLEDController:
         
         if new_low_state != self.battery_low:
             self.battery_low = new_low_state
-            GPIO.output(self.battery_pin, GPIO.HIGH if self.battery_low else GPIO.LOW)
+            self._set_pin(self.battery_pin, self.battery_low)
             
-            if DEBUG:
-                print(f"Battery: {battery_level:.1f}% - LED {'ON' if self.battery_low else 'OFF'}")
+            logging.debug("Battery: %.1f%% - LED %s", battery_level, 'ON' if self.battery_low else 'OFF')
+    
+    def open_status_watch(self) -> Optional[int]:
+        """Open an inotify fd watching for the battery status file to be published"""
+        try:
+            # Watch the directory - the monitor renames a temp file over the status file
+            return inotify_watch(os.path.dirname(BATTERY_STATUS_FILE), IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logging.debug("inotify unavailable, polling battery status: %s", e)
+            return None
+    
+    @staticmethod
+    def status_published(fd: int, published: asyncio.Event) -> None:
+        """Drain pending inotify events and flag a publish of the status file"""
+        if os.path.basename(BATTERY_STATUS_FILE).encode() in read_inotify_names(fd):
+            published.set()
+    
+    def battery_check_interval(self, battery_level: Optional[float]) -> float:
+        """Polling interval for the observed level: slow when high and steady, fast near the threshold"""
+        last, self._last_percent = self._last_percent, battery_level
+        if battery_level is None or last is None:
+            return BATTERY_CHECK_INTERVAL
+        if battery_level <= BATTERY_LOW_THRESHOLD + BATTERY_NEAR_MARGIN:
+            return BATTERY_CHECK_FAST
+        if battery_level > BATTERY_STEADY_LEVEL and abs(battery_level - last) < 1:
+            return BATTERY_CHECK_SLOW
+        return BATTERY_CHECK_MID
     
     async def battery_monitor_task(self) -> None:
-        """Periodic battery level monitoring task"""
-        while True:
-            battery_level = self.read_battery_level()
-            self.update_battery_led(battery_level)
-            await asyncio.sleep(BATTERY_CHECK_INTERVAL)
+        """Battery level monitoring task, woken whenever new status is published"""
+        loop = asyncio.get_running_loop()
+        published = asyncio.Event()
+        fd = self.open_status_watch()
+        if fd is not None:
+            loop.add_reader(fd, self.status_published, fd, published)
+        
+        try:
+            while True:
+                # File I/O and parsing run on a worker so a slow read can't delay key handling
+                battery_level = await loop.run_in_executor(None, self.read_battery_level)
+                self.update_battery_led(battery_level)
+                # Publishes wake us directly; without inotify the poll rate follows the level
+                if fd is not None:
+                    timeout = BATTERY_SAFETY_INTERVAL
+                else:
+                    timeout = self.battery_check_interval(battery_level)
+                try:
+                    # A timeout is the staleness guard: re-read even if no publish was seen
+                    await asyncio.wait_for(published.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                published.clear()
+        finally:
+            if fd is not None:
+                loop.remove_reader(fd)
+                os.close(fd)
     
     async def caps_lock_monitor_task(self) -> None:
         """Caps Lock key monitoring task"""
-        keyboard = self.find_keyboard()
-        if not keyboard:
-            raise RuntimeError("No compatible keyboard found")
-        
-        try:
-            async for event in keyboard.async_read_loop():
-                if (event.type == evdev.ecodes.EV_KEY and 
-                    event.code == evdev.ecodes.KEY_CAPSLOCK and 
-                    event.value == 1):
-                    self.toggle_caps_led()
-                    
-        except (OSError, IOError) as e:
-            if DEBUG:
-                print(f"Keyboard device error: {e}")
+        delay = KEYBOARD_RETRY_DELAY
+        while True:
+            keyboard = await self.wait_for_keyboard()
+            connected = time.monotonic()
+            try:
+                await self.read_keyboard(keyboard)
+            except (OSError, IOError) as e:
+                logging.debug("Keyboard device error: %s", e)
+            
+            keyboard.close()
             self.keyboard = None
-            await asyncio.sleep(1)
-            return await self.caps_lock_monitor_task()
+            # Back off so a flapping device can't cause a tight reconnect loop
+            if time.monotonic() - connected > KEYBOARD_RETRY_MAX:
+                delay = KEYBOARD_RETRY_DELAY
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, KEYBOARD_RETRY_MAX)
+    
+    async def read_keyboard(self, keyboard: evdev.InputDevice) -> None:
+        """Toggle the LED on Caps Lock presses until the device fails (raises OSError)"""
+        # Wake once per readable batch and drain everything queued behind it
+        fd = keyboard.fd
+        os.set_blocking(fd, False)
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(fd, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                while True:
+                    try:
+                        data = os.read(fd, INPUT_READ_SIZE)
+                    except BlockingIOError:
+                        break
+                    if not data:
+                        raise OSError("keyboard device closed")
+                    # Count presses across the batch by comparing each record's tail word;
+                    # an even count leaves the LED where it was, so write at most once
+                    tails = memoryview(data).cast('Q')[INPUT_WORDS - 1::INPUT_WORDS]
+                    if tails.tolist().count(CAPS_PRESS_WORD) & 1:
+                        self.toggle_caps_led()
+        finally:
+            # A dead device stays readable; unregister it before reconnecting
+            loop.remove_reader(fd)
     
     async def run(self) -> None:
         """Run both monitoring tasks concurrently"""
-        await asyncio.gather(
-            self.caps_lock_monitor_task(),
-            self.battery_monitor_task()
-        )
+        # If either task fails the other is cancelled, so cleanup runs right away
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.caps_lock_monitor_task())
+            tg.create_task(self.battery_monitor_task())
     
     def cleanup(self) -> None:
         """Clean up all resources"""
-        GPIO.output(self.caps_pin, GPIO.LOW)
-        GPIO.output(self.battery_pin, GPIO.LOW)
-        GPIO.cleanup()
+        self._set_pin(self.caps_pin, False)
+        self._set_pin(self.battery_pin, False)
+        # Closing the chip releases both line claims
+        lgpio.gpiochip_close(self.gpio)
         
         if self.keyboard:
             self.keyboard.close()
@@ -175,14 +406,15 @@ async def main():
     """Main entry point"""
     try:
         async with led_controller(CAPS_LED_PIN, BATTERY_LED_PIN) as controller:
-            if DEBUG:
-                print("Starting dual LED controller...")
+            logging.debug("Starting dual LED controller...")
             await controller.run()
     except KeyboardInterrupt:
-        if DEBUG:
-            print("Shutting down...")
+        logging.debug("Shutting down...")
     except Exception as e:
-        print(f"Error: {e}")
+        # Task failures arrive wrapped in an ExceptionGroup from the TaskGroup
+        for error in getattr(e, 'exceptions', (e,)):
+            logging.error("Error: %s", error)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    with asyncio.Runner(loop_factory=new_event_loop) as runner:
+        runner.run(main())